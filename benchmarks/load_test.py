@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# Measures the VSM end to end against a simulated fleet of EDGE clients.
+# Starts the given number of stand-in web commanding servers on localhost,
+# registers them with a VideoStreamManager through static discovery,
+# then requests /streams/<camera> and /status at the target rates and reports
+# throughput and latency percentiles for each.
+#
+# Each stand-in answers the Tcl commands the VSM sends, after the given
+# latency. Once the whole fleet is Active, each also fails the given fraction
+# of commands with a 500, so that failures exercise the VSM under load rather
+# than keep servers from registering. A server commanded
+# to render a camera reports a client for --view-time seconds afterward, as if
+# the viewer had connected.
+#
+# usage: python benchmarks/load_test.py [--servers N] [--stream-rate R] ...
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.pool import ThreadPool
+from SocketServer import ThreadingMixIn
+import argparse
+import collections
+import httplib
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vsm
+
+class FakeWebCommandingServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, cameras, latency, view_time):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeCommandHandler)
+        self.cameras = cameras
+        self.latency = latency
+        self.failure_rate = 0
+        self.view_time = view_time
+        self.camera = cameras[0]
+        self.viewed_until = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def get_client_count(self):
+        return int(time.time() < self.viewed_until)
+
+    def execute(self, command):
+        match = re.search(r'vsm_catalog_id ne "([^"]*)"', command)
+        if match:
+            records = [
+              'fps\t30.0',
+              'clients\t{}'.format(self.get_client_count()),
+              'rendered\t' + self.camera,
+              'catalog\t1',
+              'views\tmain']
+            if match.group(1) != '1':
+                records.append('\t'.join(['cameras'] + self.cameras))
+            return '\n'.join(records)
+        match = re.search(r'set -camera (\S+)', command)
+        if match:
+            self.camera = match.group(1)
+            self.viewed_until = time.time() + self.view_time
+            return ''
+        if command == 'doug.cmd get_fps':
+            return '30.0'
+        if command == 'get_global_var wcs_num_clients':
+            return str(self.get_client_count())
+        if command == 'doug.scene get -cameras':
+            return ' '.join(self.cameras)
+        if command == 'doug.display get -views':
+            return 'display.main'
+        if command.endswith('get -flags'):
+            return ''
+        if command.endswith('get -camera'):
+            return self.camera
+        raise ValueError('Unknown command: ' + command)
+
+class FakeCommandHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        command = urlparse.parse_qs(body)['edge_command'][0]
+        time.sleep(self.server.latency)
+        if random.random() < self.server.failure_rate:
+            return self.send_reply(500, 'Simulated failure')
+        try:
+            result = self.server.execute(command)
+        except ValueError as e:
+            return self.send_reply(500, str(e))
+        self.send_reply(200, '<response><result>{}</result></response>'.format(escape(result)))
+
+    def send_reply(self, code, content):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def start_manager(fleet, directory, configuration):
+    config_file = os.path.join(directory, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(dict({'port': 0,
+                        'log_file': os.path.join(directory, 'log.txt'),
+                        'discovery': ['static'],
+                        'snapshot_file': None,
+                        'whitelist': ['127.0.0.0/8'],
+                        'servers': ['127.0.0.1:{}'.format(server.server_address[1]) for server in fleet]},
+                       **configuration), f)
+    manager = vsm.VideoStreamManager(config_file)
+    thread = threading.Thread(target=manager.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    manager.start_discovery()
+    start = time.time()
+    # Registered isn't enough, because a server that failed its first probe is
+    # filed as Incompatible until it's retried
+    while len(manager.get_servers('Active')) < len(fleet):
+        if time.time() - start > 60:
+            sys.exit('Timed out waiting for the fleet to become active')
+        time.sleep(0.01)
+    for key, servers in sorted(manager.get_server_groups().iteritems()):
+        if servers:
+            print '{}: {} server(s)'.format(key, len(servers))
+    return manager
+
+def request(port, path):
+    start = time.time()
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+    except (httplib.HTTPException, socket.error):
+        status = 'error'
+    finally:
+        connection.close()
+    return status, time.time() - start
+
+def drive(port, paths, rate, duration, pool):
+    # Issues requests for the paths in turn at a fixed rate regardless of how
+    # long they take to complete, so that a slow VSM shows up as latency
+    # rather than as a lower offered load
+    if not rate:
+        return None
+    results = []
+    start = time.time()
+    count = int(rate * duration)
+    for i in range(count):
+        delay = start + i / float(rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        results.append(pool.apply_async(request, (port, paths[i % len(paths)])))
+    results = [result.get() for result in results]
+    return results, time.time() - start
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report(name, outcome):
+    if outcome is None:
+        return
+    results, elapsed = outcome
+    latencies = sorted(latency for status, latency in results)
+    statuses = collections.Counter(status for status, latency in results)
+    print '{:<10} {:>8} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}   {}'.format(
+      name, len(results), len(results) / elapsed,
+      percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+      latencies[-1] * 1000,
+      ', '.join('{}: {}'.format(status, count) for status, count in sorted(statuses.items())))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests the VSM against a simulated fleet.')
+    parser.add_argument('--servers', type=int, default=40, help='number of fake EDGE clients')
+    parser.add_argument('--cameras', type=int, default=20, help='number of cameras each one has')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds to answer a command')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of commands that fail')
+    parser.add_argument('--view-time', type=float, default=5, help='seconds a viewer stays connected')
+    parser.add_argument('--stream-rate', type=float, default=100, help='/streams/<camera> requests per second')
+    parser.add_argument('--status-rate', type=float, default=10, help='/status requests per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run for')
+    parser.add_argument('--concurrency', type=int, default=64, help='maximum requests in flight')
+    parser.add_argument('--config', default='{}', help='VSM configuration overrides, as JSON')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the simulated failures')
+    arguments = parser.parse_args()
+
+    random.seed(arguments.seed)
+    cameras = ['camera_{}'.format(i) for i in range(arguments.cameras)]
+    fleet = [FakeWebCommandingServer(cameras, arguments.latency, arguments.view_time)
+             for i in range(arguments.servers)]
+    # Holds the configuration and the VSM's log until the run is over
+    directory = tempfile.mkdtemp()
+    manager = start_manager(fleet, directory, json.loads(arguments.config))
+    for server in fleet:
+        server.failure_rate = arguments.failure_rate
+    port = manager.server_address[1]
+
+    pool = ThreadPool(arguments.concurrency)
+    outcomes = {}
+    threads = [threading.Thread(target=lambda name=name, paths=paths, rate=rate:
+                 outcomes.__setitem__(name, drive(port, paths, rate, arguments.duration, pool)))
+               for name, paths, rate in (
+                 ('streams', ['/streams/' + camera for camera in cameras], arguments.stream_rate),
+                 ('status', ['/status'], arguments.status_rate))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print '{:<10} {:>8} {:>10} {:>10} {:>10} {:>10}   {}'.format(
+      'route', 'requests', 'per second', 'p50 ms', 'p99 ms', 'max ms', 'statuses')
+    report('streams', outcomes['streams'])
+    report('status', outcomes['status'])
+    sys.stdout.flush()
+    shutil.rmtree(directory, ignore_errors=True)
+    # Skip tearing down the fleet and the VSM's background threads, which
+    # would only produce noise as the interpreter shuts them down
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Compares parsing a probe reply in the tab/newline record format with
+# vsm.parse_probe against evaluating the equivalent Python literal, which is
+# how replies used to be parsed. Also times the reply that omits the cameras
+# because the server's camera list is unchanged, which is the common case.
+#
+# usage: python benchmarks/reply_parsing.py [number_of_cameras ...]
+
+import ast
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vsm
+
+def make_replies(num_cameras):
+    cameras = ['camera_{}'.format(i) for i in range(num_cameras)]
+    literal = '(30.0, 2, [{}], [{}], [{}])'.format(
+      "'" + cameras[0] + "',",
+      ''.join("'" + camera + "'," for camera in cameras),
+      "'main',")
+    brief = '\n'.join([
+      'fps\t30.0',
+      'clients\t2',
+      'rendered\t' + cameras[0],
+      'catalog\t1234.5678',
+      'views\tmain'])
+    full = brief + '\n' + '\t'.join(['cameras'] + cameras)
+    return literal, full, brief
+
+def parse_literal(reply):
+    fps, num_clients, rendered_cameras, cameras, views = ast.literal_eval(reply)
+    return float(fps), num_clients, rendered_cameras, tuple(cameras), views
+
+def parse_records(reply):
+    fps, num_clients, rendered_cameras, catalog, cameras, views = vsm.parse_probe(reply)
+    return fps, num_clients, rendered_cameras, cameras, views
+
+def benchmark(function, reply):
+    number = 1000
+    return min(timeit.repeat(lambda: function(reply), number=number, repeat=5)) / number
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [10, 100, 1000]
+    print '{:>8} {:>18} {:>18} {:>8} {:>18} {:>8}'.format(
+      'cameras', 'literal_eval (us)', 'records (us)', 'speedup', 'unchanged (us)', 'speedup')
+    for size in sizes:
+        literal, full, brief = make_replies(size)
+        assert parse_literal(literal) == parse_records(full)
+        assert parse_records(brief)[3] is None
+        old = benchmark(parse_literal, literal)
+        new = benchmark(parse_records, full)
+        unchanged = benchmark(parse_records, brief)
+        print '{:>8} {:>18.1f} {:>18.1f} {:>7.1f}x {:>18.1f} {:>7.1f}x'.format(
+          size, old * 1e6, new * 1e6, old / new, unchanged * 1e6, old / unchanged)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Compares serializing a status document with write_xml against the old
+# approach of round-tripping it through minidom to add the xml-stylesheet
+# processing instruction and pretty-print it.
+#
+# usage: python benchmarks/xml_writing.py [number_of_servers ...]
+
+from xml.dom import minidom
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element, SubElement
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vsm
+
+cameras_per_server = 20
+
+def make_status(num_servers):
+    root = Element('web_commanding_servers')
+    group = SubElement(root, 'group', type='Active')
+    for i in range(num_servers):
+        wcs = SubElement(group, 'wcs', host='edge{0} (10.0.0.{0})'.format(i),
+                         port='8080', num_clients=str(i % 3))
+        for j in range(cameras_per_server):
+            # Camera names may contain quotes, which must be escaped the same way
+            name = 'camera "{}"'.format(j) if j % 2 else 'camera_{}'.format(j)
+            SubElement(wcs, 'camera', rendered=str(j == 0)).text = name
+    return root
+
+def write_minidom(root):
+    xml = minidom.parseString(ElementTree.tostring(root))
+    stylesheet = xml.createProcessingInstruction(
+        'xml-stylesheet', 'type="text/xsl" href="xsl/status.xsl"')
+    xml.insertBefore(stylesheet, xml.firstChild)
+    return xml.toprettyxml(encoding='utf8')
+
+def write_xml(root, pretty):
+    content = []
+    vsm.write_xml(content.append, root, 'status', pretty)
+    return ''.join(content)
+
+def benchmark(function, *args):
+    number = 10
+    return min(timeit.repeat(lambda: function(*args), number=number, repeat=5)) / number
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [10, 100, 500]
+    print '{:>8} {:>14} {:>14} {:>14}'.format('servers', 'minidom (ms)', 'pretty (ms)', 'compact (ms)')
+    for size in sizes:
+        root = make_status(size)
+        assert write_minidom(root) == write_xml(root, True)
+        print '{:>8} {:>14.2f} {:>14.2f} {:>14.2f}'.format(size,
+          benchmark(write_minidom, root) * 1e3,
+          benchmark(write_xml, root, True) * 1e3,
+          benchmark(write_xml, root, False) * 1e3)
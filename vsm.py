@@ -1,63 +1,341 @@
 #!/usr/bin/env python
 
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing.pool import ThreadPool
+from SocketServer import ThreadingMixIn
 from xml.etree import ElementTree
 from xml.etree.ElementTree import Element, SubElement
-from xml.dom import minidom
+from xml.sax.saxutils import escape
+from ipaddress import ipaddress
 from zeroconf import zeroconf
 from zeroconf.zeroconf import InterfaceChoice, ServiceBrowser, Zeroconf
-import ast
+import httplib
+import bisect
+import collections
+import contextlib
+import email.utils
+import hashlib
 import ifaddr
 import inspect
+import itertools
 import json
 import logging
+import mimetypes
 import operator
 import os
+import Queue
+import re
 import socket
 import sys
+import threading
+import time
 import traceback
 import urllib
 import urlparse
+import zlib
 
 vsm_home = os.path.dirname(os.path.abspath(inspect.getsourcefile(lambda:0)))
 wcs_port = 8080
+wcs_service_type = '_doug_wcs._tcp.local.'
 
-def send_wcs_command(command, host='localhost', port=wcs_port):
-    page = urllib.urlopen('http://' + str(host) + ':' + str(port) + '/command',
-                          urllib.urlencode({'edge_command': command}))
-    return ElementTree.fromstring(page.read()).find('result').text
+class DeadlineExceeded(socket.timeout):
+    pass
+
+deadline_state = threading.local()
+
+def get_deadline():
+    return getattr(deadline_state, 'expiration', None)
+
+@contextlib.contextmanager
+def deadline(expiration):
+    # Within the block, WCS commands issued by this thread fail with
+    # DeadlineExceeded rather than run past the given time, if any
+    previous = get_deadline()
+    if previous is not None and (expiration is None or previous < expiration):
+        expiration = previous
+    deadline_state.expiration = expiration
+    try:
+        yield
+    finally:
+        deadline_state.expiration = previous
+
+class Counter(object):
+
+    # A Prometheus counter, with one value per combination of label values
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+    def write(self, write):
+        write('# HELP {} {}\n# TYPE {} {}\n'.format(self.name, self.help, self.name, self.kind))
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            write('{}{} {}\n'.format(self.name, format_labels(zip(self.labels, labels)), value))
+
+class Histogram(Counter):
+
+    # A Prometheus histogram. Each combination of label values keeps a count
+    # per bucket, which is only made cumulative when written.
+
+    kind = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        Counter.__init__(self, name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def write(self, write):
+        write('# HELP {} {}\n# TYPE {} {}\n'.format(self.name, self.help, self.name, self.kind))
+        with self.lock:
+            values = sorted((labels, list(counts)) for labels, counts in self.values.iteritems())
+        for labels, counts in values:
+            labels = zip(self.labels, labels)
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                write('{}_bucket{} {}\n'.format(self.name, format_labels(labels + [('le', bound)]), total))
+            write('{}_sum{} {}\n'.format(self.name, format_labels(labels), repr(counts[-1])))
+            write('{}_count{} {}\n'.format(self.name, format_labels(labels), total))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value)
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+http_requests = Counter('vsm_http_requests_total',
+    'HTTP requests handled, by route and status code', ('route', 'code'))
+http_request_duration = Histogram('vsm_http_request_duration_seconds',
+    'Time spent handling HTTP requests, by route', ('route',))
+wcs_command_duration = Histogram('vsm_wcs_command_duration_seconds',
+    'Round-trip time of Tcl commands sent to EDGE clients, by server and command', ('wcs', 'command'))
+wcs_command_errors = Counter('vsm_wcs_command_errors_total',
+    'Tcl commands sent to EDGE clients that failed, by server and command', ('wcs', 'command'))
+poll_duration = Histogram('vsm_poll_duration_seconds',
+    'Time taken to poll a server, by whether its state changed, was unchanged or the poll failed', ('result',))
+allocations = Counter('vsm_allocations_total',
+    'Stream requests by outcome: reused a server already rendering the camera, '
+    'claimed an idle server, no such camera, no server available or timed out', ('outcome',))
+
+class ConnectionPool(object):
+
+    # Keeps idle HTTP/1.1 connections to each (host, port) open for reuse so
+    # that commands don't pay for a new TCP connection every time.
+
+    def __init__(self, connect_timeout=5, read_timeout=10, max_idle=2, max_idle_time=30):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host, port):
+        with self.lock:
+            connections = self.idle.get((host, port), [])
+            while connections:
+                connection, released = connections.pop()
+                if time.time() - released < self.max_idle_time:
+                    return connection, True
+                connection.close()
+        return httplib.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def release(self, host, port, connection):
+        with self.lock:
+            connections = self.idle.setdefault((host, port), [])
+            if len(connections) < self.max_idle:
+                connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def evict(self, host, port):
+        with self.lock:
+            connections = self.idle.pop((host, port), [])
+        for connection, released in connections:
+            connection.close()
+
+    def post(self, host, port, path, body):
+        while True:
+            # Never wait past the calling thread's deadline
+            connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+            expiration = get_deadline()
+            if expiration is not None:
+                remaining = expiration - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceeded('Deadline passed before contacting {}:{}'.format(host, port))
+                connect_timeout = min(connect_timeout, remaining)
+                read_timeout = min(read_timeout, remaining)
+
+            connection, reused = self.acquire(host, port)
+            try:
+                if not connection.sock:
+                    connection.timeout = connect_timeout
+                    connection.connect()
+                connection.sock.settimeout(read_timeout)
+                connection.request('POST', path, body,
+                  {'Content-Type': 'application/x-www-form-urlencoded'})
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                # The server may have closed an idle connection, in which case
+                # we retry on a fresh one. Anything else means the server is
+                # in trouble, so drop the rest of its connections too.
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                if (isinstance(e, socket.timeout) and expiration is not None and
+                    time.time() >= expiration):
+                    raise DeadlineExceeded('Deadline passed waiting for {}:{}'.format(host, port))
+                self.evict(host, port)
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(host, port, connection)
+
+            if response.status != httplib.OK:
+                raise httplib.HTTPException('{}:{}{} responded with {} {}'.format(
+                  host, port, path, response.status, response.reason))
+            return content
+
+connection_pool = ConnectionPool()
+
+def send_wcs_command(command, host='localhost', port=wcs_port, kind='other'):
+    # kind names the command in metrics
+    start = time.time()
+    wcs = '{}:{}'.format(host, port)
+    try:
+        reply = connection_pool.post(str(host), int(port), '/command',
+                                     urllib.urlencode({'edge_command': command}))
+    except:
+        wcs_command_errors.inc(wcs, kind)
+        raise
+    finally:
+        wcs_command_duration.observe(time.time() - start, wcs, kind)
+    return ElementTree.fromstring(reply).find('result').text
 
 def is_headless(host='localhost', port=wcs_port):
-    return float(send_wcs_command('doug.cmd get_fps', host, port)) == 0
+    return float(send_wcs_command('doug.cmd get_fps', host, port, 'get_fps')) == 0
 
 def get_client_count(host='localhost', port=wcs_port):
-    return int(send_wcs_command('get_global_var wcs_num_clients', host, port))
+    return int(send_wcs_command('get_global_var wcs_num_clients', host, port, 'get_client_count'))
 
 def get_cameras(host='localhost', port=wcs_port):
-    return tuple(send_wcs_command('doug.scene get -cameras', host, port).split())
+    return tuple(send_wcs_command('doug.scene get -cameras', host, port, 'get_cameras').split())
+
+def parse_reply(reply, keys, optional=()):
+    # Replies to our scripts are newline-separated records, each consisting of
+    # a key followed by zero or more tab-separated values. Neither separator
+    # can appear in a camera or view name.
+    records = {}
+    lines = (reply or '').strip('\n').split('\n')
+    for line in lines:
+        values = line.split('\t')
+        records[values[0]] = values[1:]
+    if (len(records) != len(lines) or not all(key in records for key in keys) or
+        not all(key in keys or key in optional for key in records)):
+        raise ValueError('Malformed reply: ' + repr(reply))
+    return records
+
+def parse_value(records, key, convert):
+    values = records[key]
+    if len(values) != 1:
+        raise ValueError('Expected one value for {} but got {}'.format(key, values))
+    return convert(values[0])
 
 def get_update(host='localhost', port=wcs_port):
-    command = """
-        set result "\["
+    command = r"""
+        set rendered {}
         foreach view [doug.display get -views] {
             set view [lindex [split $view '.'] end]
             if {[string first "HIDE" [split [doug.view $view get -flags]]] == -1} {
-                append result '[doug.view $view get -camera]',
+                lappend rendered [doug.view $view get -camera]
             }
         }
-        return "[get_global_var wcs_num_clients], $result]"
+        return [join [list \
+            [join [list clients [get_global_var wcs_num_clients]] "\t"] \
+            [join [linsert $rendered 0 rendered] "\t"]] "\n"]
     """
-    return ast.literal_eval(send_wcs_command(command, host, port))
+    records = parse_reply(send_wcs_command(command, host, port, 'update'), ('clients', 'rendered'))
+    return parse_value(records, 'clients', int), records['rendered']
+
+# Reports everything we track about a server in a single round trip. The
+# server identifies its list of cameras with an ID that changes whenever the
+# list does, and only includes the list if its ID differs from the one given.
+probe_command = r"""
+    set rendered {}
+    set views {}
+    foreach view [doug.display get -views] {
+        set view [lindex [split $view '.'] end]
+        lappend views $view
+        if {[string first "HIDE" [split [doug.view $view get -flags]]] == -1} {
+            lappend rendered [doug.view $view get -camera]
+        }
+    }
+    set cameras [doug.scene get -cameras]
+    if {![info exists ::vsm_catalog] || $::vsm_catalog ne $cameras} {
+        set ::vsm_catalog $cameras
+        set ::vsm_catalog_id [pid].[clock clicks]
+    }
+    set records [list \
+        [join [list fps [doug.cmd get_fps]] "\t"] \
+        [join [list clients [get_global_var wcs_num_clients]] "\t"] \
+        [join [linsert $rendered 0 rendered] "\t"] \
+        [join [list catalog $::vsm_catalog_id] "\t"] \
+        [join [linsert $views 0 views] "\t"]]
+    if {$::vsm_catalog_id ne "%s"} {
+        lappend records [join [linsert $cameras 0 cameras] "\t"]
+    }
+    return [join $records "\n"]
+"""
+
+def parse_probe(reply):
+    # Returns (fps, number of clients, cameras in visible views, camera list
+    # ID, all cameras or None if they were omitted, views)
+    records = parse_reply(reply, ('fps', 'clients', 'rendered', 'catalog', 'views'), ('cameras',))
+    cameras = records.get('cameras')
+    catalog = parse_value(records, 'catalog', str)
+    # The ID is sent back to the server in a Tcl string
+    if not re.match(r'[-\w.]*$', catalog):
+        raise ValueError('Invalid camera list ID: ' + repr(catalog))
+    return (parse_value(records, 'fps', float), parse_value(records, 'clients', int),
+            records['rendered'], catalog, None if cameras is None else tuple(cameras), records['views'])
+
+def probe(host='localhost', port=wcs_port, catalog=''):
+    # Returns the raw reply, for parse_probe
+    return send_wcs_command(probe_command % catalog, host, port, 'probe')
 
 def get_views(host='localhost', port=wcs_port):
-    return [view.split('.')[1] for view in send_wcs_command('doug.display get -views', host, port).split()]
+    return [view.split('.')[1] for view in send_wcs_command('doug.display get -views', host, port, 'get_views').split()]
 
 def is_view_visible(view, host='localhost', port=wcs_port):
-    result = send_wcs_command('doug.view ' + view + ' get -flags', host, port)
+    result = send_wcs_command('doug.view ' + view + ' get -flags', host, port, 'get_flags')
     return not result or 'HIDE' not in result
 
 def get_camera(view, host='localhost', port=wcs_port):
-    return send_wcs_command('doug.view ' + view + ' get -camera', host, port)
+    return send_wcs_command('doug.view ' + view + ' get -camera', host, port, 'get_camera')
 
 def set_camera(camera, host='localhost', port=wcs_port):
     command = """
@@ -70,60 +348,347 @@ def set_camera(camera, host='localhost', port=wcs_port):
         }
     """
     logging.info('Commanding {}:{} to render "{}"'.format(host, port, camera))
-    send_wcs_command(command % camera, host, port)
+    send_wcs_command(command % camera, host, port, 'set_camera')
+
+class CameraCatalog(object):
+
+    # Servers in the same scene have the same cameras, so each distinct list
+    # is stored once, with interned names, however many servers have it. The
+    # ID each server gave its list is remembered by address, so that the list
+    # isn't transferred again when a server is rediscovered.
+
+    def __init__(self):
+        self.lists = {}
+        self.servers = {}
+        self.lock = threading.Lock()
+
+    def intern(self, cameras):
+        with self.lock:
+            return self.lists.setdefault(cameras, tuple(
+                intern(camera) if isinstance(camera, str) else camera for camera in cameras))
+
+    def get(self, address, port):
+        # Returns the (ID, cameras) last reported by the server, if any
+        with self.lock:
+            return self.servers.get((address, port), ('', None))
+
+    def put(self, address, port, catalog, cameras):
+        cameras = self.intern(cameras)
+        with self.lock:
+            self.servers[address, port] = catalog, cameras
+            # Forget lists no server has anymore
+            if len(self.lists) > 2 * len(self.servers):
+                current = set(cameras for catalog, cameras in self.servers.itervalues())
+                self.lists = {cameras: cameras for cameras in current}
+        return cameras
+
+camera_catalog = CameraCatalog()
 
 class WebCommandingServer(object):
 
     def __init__(self, address, port):
         self.address = socket.inet_ntoa(address)
-        try:
-            self.hostname = socket.gethostbyaddr(self.address)[0]
-        except socket.herror as e:
-            self.hostname = e.strerror
+        # Filled in once reverse DNS completes
+        self.hostname = self.address
         self.port = port
         self.video_address = 'http://' + self.address + ':' + str(self.port) + '/video'
         self.views = []
         self.cameras = []
         self.rendered_cameras = []
         self.num_clients = 'unsupported'
+        self.fps = None
+        # Incremented whenever the server's state changes
+        self.generation = 0
+        # The parts of the last probe reply that the VSM acts on
+        self.summary = None
+        # When the poller should next update the server, and how long it
+        # waited last time
+        self.next_poll = 0
+        self.poll_interval = 0
+        # One of healthy, suspect or down, according to how many polls in a
+        # row have failed and how long ago one last succeeded
+        self.health = 'healthy'
+        self.failures = 0
+        self.updated = 0
+        # Whether a poll is in progress
+        self.polling = False
+        # Whether the state was restored from a snapshot and has yet to be
+        # confirmed by a poll
+        self.provisional = False
 
     def initialize(self):
-        self.cameras = get_cameras(self.address, self.port)
-        self.views = get_views(self.address, self.port)
         self.update()
 
     def update(self):
-        self.num_clients, self.rendered_cameras = get_update(self.address, self.port)
+        # Returns whether the server's state changed. The frame rate is
+        # measured, so it differs from poll to poll, and only whether it is
+        # zero counts as a change.
+        known, cameras = camera_catalog.get(self.address, self.port)
+        (fps, num_clients, rendered_cameras, catalog, reported,
+         views) = parse_probe(probe(self.address, self.port, known))
+        # The cameras are omitted if we already have them
+        if reported is not None:
+            cameras = camera_catalog.put(self.address, self.port, catalog, reported)
+        elif catalog != known:
+            raise ValueError('Omitted cameras from unknown list ' + catalog)
+        self.fps = fps
+        self.updated = time.time()
+        summary = (fps == 0, num_clients, tuple(rendered_cameras), catalog, tuple(views))
+        if summary == self.summary:
+            return False
+        self.num_clients = num_clients
+        self.rendered_cameras = rendered_cameras
+        self.views = views
+        self.cameras = cameras
+        self.summary = summary
+        self.generation += 1
+        return True
 
     def set_camera(self, camera):
         set_camera(camera, self.address, self.port)
+        # Reflect the change now rather than waiting for the next poll, and
+        # make sure the next poll is processed even if the reply is the same
+        # as the last one
+        self.rendered_cameras = [camera]
+        self.summary = None
+        self.generation += 1
 
     def is_headless(self):
-        return is_headless(self.address, self.port)
+        return self.fps == 0
+
+class HostnameResolver(object):
+
+    # Performs reverse DNS lookups on background threads, since they can take
+    # as long as the resolver's timeout on networks without PTR records.
+    # Results are cached for ttl seconds, and failures for negative_ttl
+    # seconds. Whenever a lookup yields a different hostname than was cached,
+    # listener is called with the address and the new hostname.
+
+    def __init__(self, listener, ttl=3600, negative_ttl=300, threads=4):
+        self.listener = listener
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        for i in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def lookup(self, address):
+        # Returns the cached hostname, or None if there isn't one yet. Missing
+        # or expired entries are looked up in the background.
+        with self.lock:
+            hostname, expiration = self.cache.get(address, (None, 0))
+            if expiration <= time.time() and address not in self.pending:
+                self.pending.add(address)
+                self.queue.put(address)
+        return hostname
+
+    def work(self):
+        while True:
+            address = self.queue.get()
+            try:
+                hostname, ttl = socket.gethostbyaddr(address)[0], self.ttl
+            except socket.error as e:
+                hostname, ttl = e.strerror or str(e), self.negative_ttl
+            with self.lock:
+                previous = self.cache.get(address, (None, 0))[0]
+                self.cache[address] = hostname, time.time() + ttl
+                self.pending.discard(address)
+            if hostname != previous:
+                try:
+                    self.listener(address, hostname)
+                except:
+                    logging.error(traceback.format_exc())
+
+class CameraIndex(object):
+
+    # Indexes Active servers by camera so that finding a server for a camera
+    # doesn't require scanning the fleet. For each camera, it tracks the
+    # servers that have it, the single-view servers currently rendering it
+    # and the idle single-view servers that could be commanded to render it.
+    # Servers that are down still count as having their cameras, but are
+    # never offered. Callers must serialize access.
+    #
+    # A server can also be reserved for a camera while it is commanded to
+    # render it and until its client connects. Until the reservation expires,
+    # the server is offered only for that camera, even though it still looks
+    # idle.
+
+    def __init__(self):
+        self.servers = {}
+        self.rendering = {}
+        self.idle = {}
+        self.entries = {}
+        self.reservations = {}
+
+    def update(self, name, wcs):
+        self.remove(name)
+        single_view = len(wcs.rendered_cameras) == 1 and wcs.health != 'down'
+        idle = single_view and not wcs.num_clients
+        rendered = None
+        if single_view and wcs.rendered_cameras[0] in wcs.cameras:
+            rendered = wcs.rendered_cameras[0]
+            self.rendering.setdefault(rendered, set()).add(name)
+        for camera in wcs.cameras:
+            self.servers.setdefault(camera, set()).add(name)
+            if idle:
+                self.idle.setdefault(camera, set()).add(name)
+        # Remember what was indexed, since the server's state may have
+        # changed by the time it is removed
+        self.entries[name] = wcs, wcs.cameras, rendered, idle
+        # The reservation has served its purpose once the client connects
+        if wcs.num_clients:
+            self.release(name)
+
+    def remove(self, name):
+        if name not in self.entries:
+            return
+        wcs, cameras, rendered, idle = self.entries.pop(name)
+        if rendered is not None:
+            self.discard(self.rendering, rendered, name)
+        for camera in cameras:
+            self.discard(self.servers, camera, name)
+            if idle:
+                self.discard(self.idle, camera, name)
+
+    def discard(self, index, camera, name):
+        names = index[camera]
+        names.discard(name)
+        if not names:
+            del index[camera]
+
+    def reserve(self, name, camera, expiration):
+        self.reservations[name] = camera, expiration
+
+    def release(self, name):
+        self.reservations.pop(name, None)
+
+    def lookup(self, camera, exclude=()):
+        # Returns whether any server has the camera, the single-view servers
+        # rendering it or reserved for it and the names of up to two
+        # unreserved idle single-view servers that have it, other than those
+        # excluded, so that the caller knows whether it has another to try
+        now = time.time()
+        for name, (reserved, expiration) in self.reservations.items():
+            if expiration <= now or name not in self.entries:
+                del self.reservations[name]
+        rendering = set(name for name in self.rendering.get(camera, ())
+                        if self.reservations.get(name, (camera,))[0] == camera)
+        rendering.update(name for name, (reserved, expiration) in self.reservations.iteritems()
+                         if reserved == camera and self.entries[name][0].health != 'down')
+        idle = list(itertools.islice((name for name in self.idle.get(camera, ())
+                                      if name not in self.reservations and name not in exclude), 2))
+        return (camera in self.servers,
+                [self.entries[name][0] for name in rendering],
+                idle)
+
+def write_xml(write, root, stylesheet, pretty=True):
+    # Serializes the tree through the given write function, preceded by an
+    # xml-stylesheet processing instruction. Pretty output matches what
+    # minidom's toprettyxml produces.
+    newline = '\n' if pretty else ''
+    write('<?xml version="1.0" encoding="utf8"?>' + newline)
+    write('<?xml-stylesheet type="text/xsl" href="xsl/' + stylesheet + '.xsl"?>' + newline)
+    write_element(write, root, '\t' if pretty else '', newline, 0)
+
+def write_element(write, element, indent, newline, depth):
+    tag = indent * depth + '<' + element.tag
+    for name, value in sorted(element.items()):
+        tag += ' ' + name + '="' + encode_xml(value) + '"'
+    children = list(element)
+    if children:
+        write(tag + '>' + newline)
+        for child in children:
+            write_element(write, child, indent, newline, depth + 1)
+        write(indent * depth + '</' + element.tag + '>' + newline)
+    elif element.text:
+        write(tag + '>' + encode_xml(element.text) + '</' + element.tag + '>' + newline)
+    else:
+        write(tag + '/>' + newline)
+
+def encode_xml(text):
+    # Escapes quotes in text as well as in attributes, as minidom does
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return escape(text, {'"': '&quot;'})
 
 class RequestHandler(BaseHTTPRequestHandler):
 
     def log_message(self, format, *args):
         logging.debug('%s - %s' % (self.client_address[0], format%args))
 
+    def send_response(self, code, message=None):
+        # Remember the status for metrics
+        self.status = code
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
     def do_GET(self):
+        start = time.time()
+        # Labelled up front so that nothing in the finally clause can mask an
+        # exception from handling the request
+        route = self.get_route(urlparse.urlparse(self.path).path)
+        self.status = 500
+        try:
+            self.route_GET()
+        finally:
+            http_requests.inc(route, self.status)
+            http_request_duration.observe(time.time() - start, route)
+
+    def get_route(self, path):
+        # Collapses the path into a label with a bounded number of values
+        if not path.startswith('/'):
+            return 'other'
+        directory = path.split('/')[1]
+        if directory in self.server.static_files:
+            return '/' + directory + '/'
+        if path.startswith('/streams/'):
+            return '/streams/<camera>'
+        if path.startswith('/api/servers/'):
+            return '/api/servers/<name>'
+        if path in ('/', '/status', '/streams', '/api/status', '/api/streams', '/metrics'):
+            return path
+        return 'other'
+
+    def route_GET(self):
         request = urlparse.urlparse(self.path)
 
-        if request.path.endswith('.xsl'):
-            return self.send_xsl_page(request.path)
+        # The path of a request for * or for an absolute URI without a path
+        # doesn't start with /
+        if request.path.startswith('/') and request.path.split('/')[1] in self.server.static_files:
+            return self.send_static_file(request.path)
 
         if request.path == '/':
             return self.send_landing_page()
 
         if request.path == '/status':
+            if self.prefers_json():
+                return self.send_status_json()
             return self.send_status_page()
 
         if request.path == '/streams':
+            if self.prefers_json():
+                return self.send_streams_json()
             return self.send_streams_page()
 
+        if request.path == '/api/status':
+            return self.send_status_json()
+
+        if request.path == '/api/streams':
+            return self.send_streams_json()
+
+        if request.path.startswith('/api/servers/'):
+            return self.send_server_json(urllib.unquote(request.path[13:]))
+
         if request.path.startswith('/streams/'):
             return self.send_stream(request)
 
+        if request.path == '/metrics':
+            return self.send_metrics()
+
         return self.send_error(404)
 
     def send_landing_page(self):
@@ -133,42 +698,156 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.wfile.write('<a href="streams">streams</a>')
 
     def send_status_page(self):
-        self.server.check_headless_servers()
-        self.send_response(200)
-        self.end_headers()
+        self.send_document('text/xml', self.server.get_document('status', self.build_status_page))
+
+    def build_status_page(self):
         root = Element('web_commanding_servers')
-        for key, servers in self.server.web_commanding_servers.iteritems():
+        for key, servers in self.server.get_server_groups().iteritems():
             group = SubElement(root, 'group', type=key)
-            for wcs in servers.values():
-                try:
-                    wcs.update()
-                except:
-                    pass
-                wcs_element = SubElement(group, 'wcs', host=wcs.hostname + ' (' + wcs.address + ')', port=str(wcs.port), num_clients=str(wcs.num_clients))
+            for name, wcs in servers:
+                wcs_element = SubElement(group, 'wcs', host=wcs.hostname + ' (' + wcs.address + ')', port=str(wcs.port), num_clients=str(wcs.num_clients), health=wcs.health)
                 for camera in wcs.cameras:
                     SubElement(wcs_element, 'camera', rendered=str(camera in wcs.rendered_cameras)).text = camera
-        self.send_xml(root, 'status')
+        return self.render_xml(root, 'status')
 
     def send_streams_page(self):
-        self.send_response(200)
-        self.end_headers()
-        root = Element('streams')
+        self.send_document('text/xml', self.server.get_document('streams', self.build_streams_page))
 
-        for streams in {wcs.cameras for wcs in self.server.web_commanding_servers['Active'].values()}:
+    def build_streams_page(self):
+        root = Element('streams')
+        for streams in {wcs.cameras for name, wcs in self.server.get_servers('Active')}:
             stream_set = SubElement(root, 'set')
             for stream in streams:
-                SubElement(stream_set, 'stream', url=self.path + '/' + stream).text = stream
-        self.send_xml(root, 'streams')
+                SubElement(stream_set, 'stream', url='/streams/' + stream).text = stream
+        return self.render_xml(root, 'streams')
 
-    def send_xml(self, root, stylesheet):
-        xml = minidom.parseString(ElementTree.tostring(root))
-        stylesheet = xml.createProcessingInstruction(
-            'xml-stylesheet', 'type="text/xsl" href="xsl/' + stylesheet + '.xsl"')
-        xml.insertBefore(stylesheet, xml.firstChild)
-        self.wfile.write(xml.toprettyxml(encoding='utf8'))
+    def send_status_json(self):
+        self.send_document('application/json', self.server.get_document('api/status', self.build_status_json))
+
+    def build_status_json(self):
+        return self.render_json({key: [self.describe_server(name, wcs) for name, wcs in servers]
+                                 for key, servers in self.server.get_server_groups().iteritems()})
+
+    def send_streams_json(self):
+        self.send_document('application/json', self.server.get_document('api/streams', self.build_streams_json))
+
+    def build_streams_json(self):
+        return self.render_json([list(streams)
+            for streams in {wcs.cameras for name, wcs in self.server.get_servers('Active')}])
+
+    def send_server_json(self, name):
+        # Accept either the full service name or, for servers found through
+        # zeroconf, just its instance name. Servers found otherwise are named
+        # host:port, which may itself contain dots.
+        suffix = '.' + wcs_service_type
+        for key, servers in self.server.get_server_groups().iteritems():
+            for server_name, wcs in servers:
+                if name == server_name or (server_name.endswith(suffix) and
+                                           name == server_name[:-len(suffix)]):
+                    return self.send_document('application/json', self.server.get_document(
+                      'api/servers/' + server_name, lambda: self.render_json(
+                        dict(self.describe_server(server_name, wcs), group=key))))
+        self.send_error(404, 'No such server exists')
+
+    def describe_server(self, name, wcs):
+        return {'name': name,
+                'hostname': wcs.hostname,
+                'address': wcs.address,
+                'port': wcs.port,
+                'num_clients': wcs.num_clients,
+                'cameras': wcs.cameras,
+                'rendered_cameras': wcs.rendered_cameras,
+                'views': wcs.views,
+                'generation': wcs.generation,
+                'health': wcs.health,
+                'failures': wcs.failures,
+                'provisional': wcs.provisional}
+
+    def render_json(self, document):
+        return json.dumps(document, separators=(',', ':'))
+
+    def prefers_json(self):
+        # Serve JSON only if the client explicitly ranks it above XML, so
+        # that browsers and clients that accept anything still get XML
+        return self.get_quality('application/json') > max(
+          self.get_quality('application/xml'), self.get_quality('text/xml'))
+
+    def get_quality(self, media_type):
+        # Returns the quality the Accept header assigns to the media type,
+        # taken from the most specific range that matches it
+        quality, specificity = 0, -1
+        for media_range in self.headers.get('Accept', '*/*').split(','):
+            parameters = media_range.split(';')
+            range_type = parameters[0].strip().lower()
+            if range_type == media_type:
+                range_specificity = 2
+            elif range_type == media_type.split('/')[0] + '/*':
+                range_specificity = 1
+            elif range_type == '*/*':
+                range_specificity = 0
+            else:
+                continue
+            if range_specificity > specificity:
+                specificity = range_specificity
+                quality = 1.0
+                for parameter in parameters[1:]:
+                    name, _, value = parameter.partition('=')
+                    if name.strip() == 'q':
+                        try:
+                            quality = float(value)
+                        except ValueError:
+                            quality = 0
+        return quality
+
+    def render_xml(self, root, stylesheet):
+        content = []
+        write_xml(content.append, root, stylesheet, self.server.configuration['pretty_xml'])
+        return ''.join(content)
+
+    def send_document(self, content_type, document):
+        etag, modified, content = document
+        # /status and /streams serve XML or JSON depending on Accept. Clients
+        # may cache documents, but must revalidate every time.
+        self.send_cacheable(content_type, etag, modified, content,
+                            {'Vary': 'Accept', 'Cache-Control': 'no-cache'})
+
+    def send_cacheable(self, content_type, etag, modified, content, headers):
+        not_modified = self.is_not_modified(etag, modified)
+        if not_modified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(modified))
+        for header, value in headers.iteritems():
+            self.send_header(header, value)
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(content)
+
+    def is_not_modified(self, etag, modified):
+        # If-None-Match takes precedence over If-Modified-Since
+        if 'If-None-Match' in self.headers:
+            tags = [tag.strip() for tag in self.headers['If-None-Match'].split(',')]
+            return etag in tags or '*' in tags
+        if 'If-Modified-Since' in self.headers:
+            since = email.utils.parsedate_tz(self.headers['If-Modified-Since'])
+            return since is not None and int(modified) <= email.utils.mktime_tz(since)
+        return False
 
     def send_stream(self, request):
-        exists, wcs = self.server.get_wcs_for_camera(request.path[9:])
+        # Bound the time spent on every WCS command this request triggers
+        try:
+            with deadline(time.time() + self.server.configuration['request_deadline']):
+                exists, wcs = self.server.get_wcs_for_camera(request.path[9:])
+        except DeadlineExceeded:
+            allocations.inc('timed_out')
+            self.send_error(503,
+                'This camera is temporarily unavailable because the EDGE '
+                'client chosen to render it did not respond in time')
+            return
 
         if not exists:
             self.send_error(404, 'No such camera exists')
@@ -189,29 +868,413 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         logging.info('Redirecting to {}'.format(wcs.video_address))
 
-    def send_xsl_page(self, path):
+    def send_metrics(self):
+        # Serves the metrics in the Prometheus text exposition format
+        content = []
+        for metric in (http_requests, http_request_duration, wcs_command_duration,
+                       wcs_command_errors, poll_duration, allocations):
+            metric.write(content.append)
+        content.append('# HELP vsm_discovery_queue_depth Discovery events waiting to be processed\n'
+                       '# TYPE vsm_discovery_queue_depth gauge\n'
+                       'vsm_discovery_queue_depth {}\n'.format(len(self.server.discovery_queue)))
+        content = ''.join(content)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_static_file(self, path):
+        directory, _, name = path[1:].partition('/')
+        static_file = self.server.static_files[directory].get(name)
+        if not static_file:
+            return self.send_error(404)
+
+        content_type, etag, modified, content, compressed = static_file
+        headers = {'Cache-Control': 'max-age={:d}'.format(self.server.configuration['static_max_age']),
+                   'Vary': 'Accept-Encoding'}
+        if compressed and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = compressed
+            # Each encoding is a different representation, so it needs its
+            # own ETag
+            etag = etag[:-1] + '-gzip"'
+            headers['Content-Encoding'] = 'gzip'
+        self.send_cacheable(content_type, etag, modified, content, headers)
+
+class StaticFiles(object):
+
+    # Serves the files in one of our directories from memory. Files are
+    # loaded up front and reloaded whenever their modification time changes.
+
+    content_types = {'.xsl': 'text/xsl'}
+
+    def __init__(self, directory):
+        self.directory = os.path.join(vsm_home, directory)
+        self.files = {}
+        for name in os.listdir(self.directory):
+            self.get(name)
+
+    def get(self, name):
+        # Returns (content type, ETag, modification time, content, gzipped
+        # content) for the file, or None if there is no such file. The
+        # gzipped content is None if compressing doesn't make it smaller.
+        path = os.path.join(self.directory, name)
+        if os.path.dirname(os.path.normpath(path)) != self.directory:
+            return None
         try:
-            xsl = open(vsm_home + os.sep + path)
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(xsl.read())
-        except Exception, e:
-            self.send_error(404, str(e))
+            modified = os.stat(path).st_mtime
+        except OSError:
+            self.files.pop(name, None)
+            return None
 
-class VideoStreamManager(HTTPServer):
+        static_file = self.files.get(name)
+        if static_file and static_file[2] == modified:
+            return static_file
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        extension = os.path.splitext(name)[1]
+        content_type = (self.content_types.get(extension) or
+          mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(content) + compressor.flush()
+        static_file = (content_type, '"' + hashlib.md5(content).hexdigest() + '"', modified,
+                       content, compressed if len(compressed) < len(content) else None)
+        self.files[name] = static_file
+        return static_file
+
+def parse_network(entry):
+    # Returns the networks covering a CIDR network ("10.0.0.0/24"), an
+    # inclusive address range ("10.0.0.5-10.0.0.20") or a single address, or
+    # None if the entry is none of these, in which case it should be a name
+    first, separator, last = unicode(entry).partition('-')
+    try:
+        if separator:
+            return list(ipaddress.summarize_address_range(
+              ipaddress.ip_address(first.strip()), ipaddress.ip_address(last.strip())))
+        return [ipaddress.ip_network(first.strip(), strict=False)]
+    except (ValueError, TypeError):
+        return None
+
+class AddressSet(object):
+
+    # A set of IPv4 and IPv6 addresses, stored as sorted, disjoint ranges of
+    # integers so that a lookup is a binary search, however many networks
+    # the set was built from.
+
+    def __init__(self, networks):
+        self.ranges = {}
+        for version in (4, 6):
+            starts, ends = [], []
+            for network in ipaddress.collapse_addresses(
+              [network for network in networks if network.version == version]):
+                start, end = int(network.network_address), int(network.broadcast_address)
+                # Adjacent networks that don't form a larger network are still
+                # a single range
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.ranges[version] = starts, ends
+
+    def __contains__(self, address):
+        try:
+            address = ipaddress.ip_address(unicode(address))
+        except ValueError:
+            return False
+        starts, ends = self.ranges[address.version]
+        index = bisect.bisect_right(starts, int(address)) - 1
+        return index >= 0 and int(address) <= ends[index]
+
+    def __eq__(self, other):
+        return isinstance(other, AddressSet) and self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return ', '.join('{}-{}'.format(ipaddress.ip_address(start), ipaddress.ip_address(end))
+            for version in (4, 6)
+            for start, end in zip(*self.ranges[version]))
+
+class AccessList(object):
+
+    # A whitelist or blacklist of machine names, addresses, CIDR networks and
+    # address ranges. refresh resolves the names, which must be done
+    # periodically to follow DHCP changes. A name that fails to resolve keeps
+    # its previous addresses. Everything but the names is in effect from the
+    # start.
+
+    def __init__(self, names, resolve):
+        self.names = names
+        self.resolve = resolve
+        self.resolved = {}
+        self.addresses = AddressSet([network
+            for name in names
+            for network in parse_network(name) or []])
+        self.has_names = any(parse_network(name) is None for name in names)
+
+    def __contains__(self, address):
+        return address in self.addresses
+
+    def refresh(self):
+        # Returns whether the list's addresses changed
+        resolved = {}
+        for name in self.names:
+            networks = parse_network(name)
+            if networks is None:
+                try:
+                    networks = [ipaddress.ip_network(unicode(address))
+                                for address in self.resolve(name)]
+                except socket.error as e:
+                    networks = self.resolved.get(name, [])
+                    logging.error('Failed to resolve {}: {}'.format(name, e))
+            resolved[name] = networks
+        self.resolved = resolved
+        addresses = AddressSet([network
+            for networks in resolved.values()
+            for network in networks])
+        changed = addresses != self.addresses
+        if changed:
+            logging.info('Access list {} now covers {}'.format(self.names, addresses))
+        self.addresses = addresses
+        return changed
+
+class DiscoveryQueue(object):
+
+    # Handles service events on a pool of worker threads so that initializing
+    # a new server doesn't hold up discovery of the others. Only the latest
+    # pending event for each service is kept, events for the same service
+    # are never handled concurrently, and put blocks while max_pending
+    # services are waiting, which pushes back on the caller.
+
+    def __init__(self, workers, max_pending):
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.busy = set()
+        self.condition = threading.Condition()
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def offer(self, name, function, *args):
+        # Like put, but does nothing if an event for the service is already
+        # pending, since it is the more recent
+        with self.condition:
+            while name not in self.pending and len(self.pending) >= self.max_pending:
+                self.condition.wait()
+            if name in self.pending:
+                return False
+            self.pending[name] = function, args
+            self.condition.notify_all()
+            return True
+
+    def put(self, name, function, *args):
+        with self.condition:
+            while name not in self.pending and len(self.pending) >= self.max_pending:
+                self.condition.wait()
+            # A replaced event keeps its place in line
+            self.pending[name] = function, args
+            self.condition.notify_all()
+
+    def take(self):
+        with self.condition:
+            while True:
+                for name in self.pending:
+                    if name not in self.busy:
+                        function, args = self.pending.pop(name)
+                        self.busy.add(name)
+                        self.condition.notify_all()
+                        return name, function, args
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            name, function, args = self.take()
+            try:
+                function(name, *args)
+            except:
+                logging.error(traceback.format_exc())
+            with self.condition:
+                self.busy.discard(name)
+                self.condition.notify_all()
+
+class ServiceInfo(object):
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+
+class StaticDiscovery(object):
+
+    # Announces a fixed list of servers, each given as host or host:port, to
+    # the listener the same way zeroconf's ServiceBrowser would. Hosts are
+    # only resolved as each server is registered, on the discovery workers.
+    # Unlike zeroconf, nothing announces a server again when it comes up, so
+    # every retry_interval seconds the listener is asked to retry the ones it
+    # couldn't resolve or initialize.
+
+    def __init__(self, listener, entries, retry_interval=30):
+        self.listener = listener
+        self.entries = entries
+        self.retry_interval = retry_interval
+        self.names = set()
+
+    def start(self):
+        self.names = set(self.parse(self.entries))
+        for name in self.names:
+            self.listener.add_service(self, wcs_service_type, name)
+        self.start_thread(self.retry)
+
+    def start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def retry(self):
+        while True:
+            time.sleep(self.retry_interval)
+            try:
+                for name in list(self.names):
+                    # The name may have been removed in the meantime
+                    if name in self.names:
+                        self.listener.retry_service(self, wcs_service_type, name)
+            except:
+                logging.error(traceback.format_exc())
+
+    def parse(self, entries):
+        # Returns the servers' names, which are their host:port
+        names = []
+        for entry in entries:
+            entry = entry.strip()
+            if entry and not entry.startswith('#'):
+                host, separator, port = entry.partition(':')
+                names.append('{}:{}'.format(host, int(port) if separator else wcs_port))
+        return names
+
+    def get_service_info(self, service, name):
+        host, port = name.rsplit(':', 1)
+        try:
+            return ServiceInfo(socket.inet_aton(socket.gethostbyname(host)), int(port))
+        except socket.error as e:
+            logging.error('Failed to resolve {}: {}'.format(host, e))
+
+class FileDiscovery(StaticDiscovery):
+
+    # Announces the servers listed in a file, one per line, and checks it for
+    # changes every interval seconds, adding and removing servers to match.
+    # Blank lines and lines starting with # are ignored. If the file can't be
+    # read, the servers last listed in it are kept.
+
+    def __init__(self, listener, path, interval=5, retry_interval=30):
+        StaticDiscovery.__init__(self, listener, [], retry_interval)
+        self.path = path
+        self.interval = interval
+        self.modified = None
+
+    def start(self):
+        self.check()
+        self.start_thread(self.watch)
+        self.start_thread(self.retry)
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except:
+                logging.error(traceback.format_exc())
+
+    def check(self):
+        try:
+            modified = os.stat(self.path).st_mtime
+            if modified == self.modified:
+                return
+            with open(self.path) as servers_file:
+                names = set(self.parse(servers_file))
+        except (IOError, OSError, ValueError) as e:
+            logging.error('Failed to read servers from {}: {}'.format(self.path, e))
+            return
+        self.modified = modified
+        for name in names - self.names:
+            self.listener.add_service(self, wcs_service_type, name)
+        for name in self.names - names:
+            self.listener.remove_service(self, wcs_service_type, name)
+        self.names = names
+
+class VideoStreamManager(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    # The type of each numeric setting
+    numeric_settings = {'access_list_ttl': float,
+                        'discovery_retry_interval': float,
+                        'discovery_workers': int,
+                        'down_threshold': int,
+                        'hostname_negative_ttl': float,
+                        'hostname_ttl': float,
+                        'max_concurrent_queries': int,
+                        'max_idle_connections': int,
+                        'max_idle_time': float,
+                        'max_pending_discoveries': int,
+                        'max_poll_interval': float,
+                        'max_retry_interval': float,
+                        'max_staleness': float,
+                        'poll_interval': float,
+                        'port': int,
+                        'request_deadline': float,
+                        'reservation_lease': float,
+                        'servers_file_interval': float,
+                        'snapshot_interval': float,
+                        'static_max_age': int,
+                        'wcs_connect_timeout': float,
+                        'wcs_read_timeout': float}
 
     def __init__(self, config_file=None):
         # default configuration
-        self.configuration = {'interfaces': InterfaceChoice.All,
+        self.configuration = {'access_list_ttl': 300,
+                              'interfaces': InterfaceChoice.All,
+                              'discovery': ['zeroconf'],
+                              'discovery_retry_interval': 30,
+                              'discovery_workers': 8,
+                              'down_threshold': 3,
+                              'hostname_negative_ttl': 300,
+                              'hostname_ttl': 3600,
                               'log_file': vsm_home + os.sep + 'log.txt',
-                              'port': 12345}
+                              'max_concurrent_queries': 16,
+                              'max_idle_connections': 2,
+                              'max_idle_time': 30,
+                              'max_pending_discoveries': 256,
+                              'max_poll_interval': 8,
+                              'max_retry_interval': 60,
+                              'max_staleness': 30,
+                              'poll_interval': 1,
+                              'port': 12345,
+                              'pretty_xml': True,
+                              'request_deadline': 5,
+                              'reservation_lease': 10,
+                              'servers': [],
+                              'servers_file': None,
+                              'servers_file_interval': 5,
+                              'snapshot_file': vsm_home + os.sep + 'snapshot.json',
+                              'snapshot_interval': 5,
+                              'static_max_age': 300,
+                              'threaded': True,
+                              'wcs_connect_timeout': 5,
+                              'wcs_read_timeout': 10}
 
         # overwrite defaults with config file contents
         if config_file:
             with open(config_file) as config_json:
                 self.configuration.update(json.load(config_json))
-                # in case the port was specified as a string
-                self.configuration['port'] = int(self.configuration['port'])
+                # in case numbers were specified as strings
+                for key, convert in self.numeric_settings.iteritems():
+                    self.configuration[key] = convert(self.configuration[key])
 
         # This isn't in the initial assignment because the presence of a whitelist
         # causes any blacklist to be ignored, which would make it impossible to
@@ -224,125 +1287,556 @@ class VideoStreamManager(HTTPServer):
           format='[%(asctime)s.%(msecs)03d %(levelname)s] %(message)s',
           datefmt='%m/%d/%Y %I:%M:%S')
 
+        # An unchanged server is polled every max_poll_interval seconds, and a
+        # poll may take up to the connect and read timeouts, so a server's
+        # state can't be expected to be any fresher than that
+        minimum_staleness = (self.configuration['max_poll_interval'] +
+                             self.configuration['wcs_connect_timeout'] + self.configuration['wcs_read_timeout'])
+        if self.configuration['max_staleness'] <= minimum_staleness:
+            logging.warning('max_staleness must exceed max_poll_interval plus wcs_connect_timeout plus '
+              'wcs_read_timeout. Using {}.'.format(minimum_staleness + self.configuration['poll_interval']))
+            self.configuration['max_staleness'] = minimum_staleness + self.configuration['poll_interval']
+
+        # The names in these lists are resolved in the background
+        self.access_lists = {}
         for machine_list in ['whitelist', 'blacklist']:
             if machine_list in self.configuration:
-                if isinstance(self.configuration[machine_list], (str, unicode)):
-                    self.configuration[machine_list] = self.resolve_name(self.configuration[machine_list])
-                else:
-                    self.configuration[machine_list] = set([entry
-                        for name in self.configuration[machine_list]
-                        for entry in self.resolve_name(name)])
+                names = self.configuration[machine_list]
+                if isinstance(names, (str, unicode)):
+                    names = [names]
+                self.access_lists[machine_list] = AccessList(names, self.resolve_name)
+        # Set once the names in the lists have first been resolved. Until then,
+        # servers can't be classified.
+        self.access_lists_ready = threading.Event()
+        if not any(access_list.has_names for access_list in self.access_lists.values()):
+            self.access_lists_ready.set()
+
+        connection_pool.connect_timeout = self.configuration['wcs_connect_timeout']
+        connection_pool.read_timeout = self.configuration['wcs_read_timeout']
+        connection_pool.max_idle = self.configuration['max_idle_connections']
+        connection_pool.max_idle_time = self.configuration['max_idle_time']
 
         HTTPServer.__init__(self, ('0.0.0.0', self.configuration['port']), RequestHandler)
         self.web_commanding_servers = {'Active': {}, 'Incompatible': {}, 'Blacklisted': {}, 'Headless': {}}
-        self.browser = ServiceBrowser(Zeroconf(self.configuration['interfaces']), '_doug_wcs._tcp.local.', self)
+        # Guards web_commanding_servers, which is shared by the request
+        # handlers, the poller and zeroconf
+        self.lock = threading.RLock()
+        # Indexes the Active servers by camera. Also guarded by lock.
+        self.camera_index = CameraIndex()
+        # Incremented whenever the servers' state changes, so that documents
+        # built from it know when to rebuild. Also guarded by lock.
+        self.version = 0
+        self.modified = time.time()
+        self.documents = {}
+        self.static_files = {'xsl': StaticFiles('xsl')}
+        self.query_pool = ThreadPool(self.configuration['max_concurrent_queries'])
+        self.poller = threading.Thread(target=self.poll_web_commanding_servers)
+        self.poller.daemon = True
+        self.poller.start()
+        self.hostname_resolver = HostnameResolver(self.set_hostname,
+                                                  self.configuration['hostname_ttl'],
+                                                  self.configuration['hostname_negative_ttl'])
+        self.discovery_queue = DiscoveryQueue(self.configuration['discovery_workers'],
+                                              self.configuration['max_pending_discoveries'])
+        self.access_list_refresher = threading.Thread(target=self.refresh_access_lists)
+        self.access_list_refresher.daemon = True
+        self.access_list_refresher.start()
+        if self.configuration['snapshot_file']:
+            if self.access_lists_ready.is_set():
+                self.load_snapshot()
+            else:
+                # The restored servers must be checked against the access
+                # lists, which aren't resolved yet
+                self.snapshot_loader = threading.Thread(target=self.load_snapshot)
+                self.snapshot_loader.daemon = True
+                self.snapshot_loader.start()
+            self.snapshot_writer = threading.Thread(target=self.write_snapshots)
+            self.snapshot_writer.daemon = True
+            self.snapshot_writer.start()
         logging.info('VSM running at http://{}:{}'.format(*self.server_address))
-        self.serve_forever()
+
+    def start_discovery(self):
+        # Servers can be discovered through any combination of zeroconf, the
+        # servers listed in the configuration and those listed in a file. All
+        # of them call add_service and remove_service.
+        for backend in self.configuration['discovery']:
+            if backend == 'zeroconf':
+                self.browser = ServiceBrowser(Zeroconf(self.configuration['interfaces']), wcs_service_type, self)
+            elif backend == 'static':
+                StaticDiscovery(self, self.configuration['servers'],
+                                self.configuration['discovery_retry_interval']).start()
+            elif backend == 'file':
+                if not self.configuration['servers_file']:
+                    raise ValueError('The file discovery backend requires servers_file')
+                FileDiscovery(self, self.configuration['servers_file'],
+                              self.configuration['servers_file_interval'],
+                              self.configuration['discovery_retry_interval']).start()
+            else:
+                raise ValueError('Unknown discovery backend: ' + backend)
+            logging.info('Discovering servers through ' + backend)
+
+    def process_request(self, request, client_address):
+        if self.configuration['threaded']:
+            ThreadingMixIn.process_request(self, request, client_address)
+        else:
+            HTTPServer.process_request(self, request, client_address)
+
+    def get_servers(self, key):
+        with self.lock:
+            return self.web_commanding_servers[key].items()
+
+    def get_server_groups(self):
+        with self.lock:
+            return {key: servers.items()
+                    for key, servers in self.web_commanding_servers.iteritems()}
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.modified = time.time()
+
+    def get_document(self, key, build):
+        # Returns the (ETag, modification time, content) of the document,
+        # calling build to regenerate the content only if the servers' state
+        # has changed since it was last built
+        with self.lock:
+            version, modified = self.version, self.modified
+        document = self.documents.get(key)
+        if not document or document[0] != version:
+            content = build()
+            etag = '"' + hashlib.md5(content).hexdigest() + '"'
+            document = version, (etag, modified, content)
+            self.documents[key] = document
+        return document[1]
+
+    def set_hostname(self, address, hostname):
+        with self.lock:
+            for servers in self.web_commanding_servers.values():
+                for wcs in servers.values():
+                    if wcs.address == address:
+                        wcs.hostname = hostname
+        self.invalidate()
+
+    def reindex(self, name, wcs):
+        with self.lock:
+            if self.web_commanding_servers['Active'].get(name) is wcs:
+                self.camera_index.update(name, wcs)
 
     def resolve_name(self, name):
-        if name == 'localhost' or socket.gethostbyname(name) == '127.0.0.1':
-            return set([ip.ip
-                for adapter in ifaddr.get_adapters()
-                for ip in adapter.ips
-                if isinstance(ip.ip, str)])
-        return [socket.gethostbyname(name)]
+        if name != 'localhost':
+            addresses = socket.gethostbyname_ex(name)[2]
+            if '127.0.0.1' not in addresses:
+                return addresses
+        return set([ip.ip
+            for adapter in ifaddr.get_adapters()
+            for ip in adapter.ips
+            if isinstance(ip.ip, str)])
 
     def is_blacklisted(self, wcs):
-        if 'whitelist' in self.configuration:
-            return wcs.address not in self.configuration['whitelist']
-        return 'blacklist' in self.configuration and wcs.address in self.configuration['blacklist']
+        if 'whitelist' in self.access_lists:
+            return wcs.address not in self.access_lists['whitelist']
+        return 'blacklist' in self.access_lists and wcs.address in self.access_lists['blacklist']
+
+    def refresh_access_lists(self):
+        while True:
+            changed = False
+            for access_list in self.access_lists.values():
+                if access_list.refresh():
+                    changed = True
+            # Anything filed before the first pass is checked too, even if
+            # the lists resolved to nothing
+            if changed or not self.access_lists_ready.is_set():
+                self.check_access_lists()
+            self.access_lists_ready.set()
+            time.sleep(self.configuration['access_list_ttl'])
+
+    def check_access_lists(self):
+        for key, servers in self.get_server_groups().iteritems():
+            for name, wcs in servers:
+                blacklisted = self.is_blacklisted(wcs)
+                if blacklisted and key != 'Blacklisted':
+                    self.move_server(name, wcs, key, 'Blacklisted')
+                elif not blacklisted and key == 'Blacklisted':
+                    # The server has never been initialized, so classify it
+                    # from scratch. A pending event for it will do that anyway.
+                    self.discovery_queue.offer(name, self.classify_service, wcs)
+
+    def load_snapshot(self):
+        # Restores the servers saved by write_snapshot as provisional state,
+        # so that redirects can be served right away. The poller revalidates
+        # them in the background. Any that can't be reached are forgotten
+        # until they are discovered again, and any that the access lists now
+        # exclude are skipped.
+        self.access_lists_ready.wait()
+        path = self.configuration['snapshot_file']
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            camera_lists = [tuple(cameras) for cameras in snapshot['cameras']]
+            servers = [(name, key, socket.inet_aton(address), port, fps, num_clients,
+                        rendered_cameras, camera_lists[cameras], views)
+                       for name, key, address, port, fps, num_clients, rendered_cameras, cameras, views
+                       in snapshot['servers'] if key in ('Active', 'Headless')]
+        except (IOError, ValueError, KeyError, IndexError, TypeError, socket.error) as e:
+            logging.error('Failed to load the snapshot from {}: {}'.format(path, e))
+            return
+
+        restored = 0
+        with self.lock:
+            for name, key, address, port, fps, num_clients, rendered_cameras, cameras, views in servers:
+                # Discovery may already have found the server
+                if any(name in group for group in self.web_commanding_servers.values()):
+                    continue
+                wcs = WebCommandingServer(address, port)
+                if self.is_blacklisted(wcs):
+                    continue
+                wcs.fps = fps
+                wcs.num_clients = num_clients
+                wcs.rendered_cameras = rendered_cameras
+                wcs.cameras = camera_catalog.intern(cameras)
+                wcs.views = views
+                wcs.provisional = True
+                # Give the poller as long to confirm the state as it would
+                # have for a server it had just polled
+                wcs.updated = time.time()
+                wcs.hostname = self.hostname_resolver.lookup(wcs.address) or wcs.address
+                self.web_commanding_servers[key][name] = wcs
+                if key == 'Active':
+                    self.camera_index.update(name, wcs)
+                restored += 1
+        self.invalidate()
+        logging.info('Restored {} of {} server(s) from {}'.format(restored, len(servers), path))
+
+    def write_snapshots(self):
+        written = None
+        while True:
+            time.sleep(self.configuration['snapshot_interval'])
+            try:
+                with self.lock:
+                    version = self.version
+                if version != written:
+                    self.write_snapshot()
+                    written = version
+            except:
+                logging.error(traceback.format_exc())
+
+    def write_snapshot(self):
+        # Saves the Active and Headless servers that aren't down. Each distinct
+        # list of cameras, which is typically shared by many servers, is only
+        # stored once.
+        camera_lists = {}
+        servers = []
+        with self.lock:
+            for key in ('Active', 'Headless'):
+                for name, wcs in self.web_commanding_servers[key].iteritems():
+                    if wcs.health != 'down':
+                        servers.append([name, key, wcs.address, wcs.port, wcs.fps, wcs.num_clients,
+                                        wcs.rendered_cameras,
+                                        camera_lists.setdefault(wcs.cameras, len(camera_lists)),
+                                        wcs.views])
+        path = self.configuration['snapshot_file']
+        with open(path + '.tmp', 'w') as snapshot_file:
+            json.dump({'cameras': sorted(camera_lists, key=camera_lists.get), 'servers': servers},
+                      snapshot_file, separators=(',', ':'))
+        # Replace the snapshot in one step so that it's never left half
+        # written. Windows won't rename over an existing file.
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def forget_server(self, name, wcs, error):
+        with self.lock:
+            for servers in self.web_commanding_servers.values():
+                if servers.get(name) is wcs:
+                    del servers[name]
+                    self.camera_index.remove(name)
+        connection_pool.evict(wcs.address, wcs.port)
+        logging.warning('Forgot {} @ {}:{}, which was restored from the snapshot but failed to respond: {}'
+          .format(name, wcs.address, wcs.port, error))
 
     def add_service(self, zeroconf, service, name):
+        self.discovery_queue.put(name, self.register_service, zeroconf, service)
+
+    def remove_service(self, zeroconf, service, name):
+        self.discovery_queue.put(name, self.unregister_service)
+
+    def retry_service(self, zeroconf, service, name):
+        # Registers the service again unless it's already registered, other
+        # than as Incompatible. A pending event for it is left alone, since it
+        # is the more recent.
+        with self.lock:
+            registered = any(name in servers for key, servers in self.web_commanding_servers.iteritems()
+                             if key != 'Incompatible')
+        if not registered:
+            self.discovery_queue.offer(name, self.register_service, zeroconf, service)
+
+    def register_service(self, name, zeroconf, service):
         info = zeroconf.get_service_info(service, name)
         if info:
-            wcs = WebCommandingServer(info.address, info.port)
-            if self.is_blacklisted(wcs):
-                key = 'Blacklisted'
-            else:
-                try:
-                    wcs.initialize()
-                    if wcs.is_headless():
-                        key = 'Headless'
-                    else:
-                        key = 'Active'
-                except:
-                    key = 'Incompatible'
-                    logging.error(traceback.format_exc())
-            self.web_commanding_servers[key][name] = wcs
-            logging.info('Found {} {} @ {}:{}'.format(key, name, wcs.address, wcs.port))
+            self.classify_service(name, WebCommandingServer(info.address, info.port))
         else:
             logging.error('Failed to retrieve service information for ' + name)
 
-    def remove_service(self, zeroconf, service, name):
-        for servers in self.web_commanding_servers.values():
-            servers.pop(name, None)
+    def classify_service(self, name, wcs):
+        self.access_lists_ready.wait()
+        if self.is_blacklisted(wcs):
+            key = 'Blacklisted'
+        else:
+            try:
+                wcs.initialize()
+                if wcs.is_headless():
+                    key = 'Headless'
+                else:
+                    key = 'Active'
+            except:
+                key = 'Incompatible'
+                logging.error(traceback.format_exc())
+        with self.lock:
+            # Replace any previous instance, which may have been filed
+            # under a different key
+            for servers in self.web_commanding_servers.values():
+                servers.pop(name, None)
+            self.camera_index.remove(name)
+            # Looking up the hostname while holding the lock ensures that
+            # set_hostname will see this server if the lookup is pending
+            wcs.hostname = self.hostname_resolver.lookup(wcs.address) or wcs.address
+            self.web_commanding_servers[key][name] = wcs
+            if key == 'Active':
+                self.camera_index.update(name, wcs)
+        self.invalidate()
+        logging.info('Found {} {} @ {}:{}'.format(key, name, wcs.address, wcs.port))
+
+    def unregister_service(self, name):
+        with self.lock:
+            lost = [servers.pop(name) for servers in self.web_commanding_servers.values()
+                    if name in servers]
+            self.camera_index.remove(name)
+        self.invalidate()
+        for wcs in lost:
+            connection_pool.evict(wcs.address, wcs.port)
         logging.info('Lost {}'.format(name))
 
     def check_headless_servers(self):
-        for name, wcs in self.web_commanding_servers['Headless'].items():
-            try:
-                if (not wcs.is_headless()):
-                    del self.web_commanding_servers['Headless'][name]
-                    self.web_commanding_servers['Active'][name] = wcs
-                    logging.info('Moved {} @ {}:{} from Headless to Active'
-                      .format(name, wcs.address, wcs.port))
-            except:
-                self.remove_service(None, None, name)
+        # Headless servers are kept up to date by the poller, so this only
+        # moves the ones that have started rendering
+        for name, wcs in self.get_servers('Headless'):
+            if not wcs.is_headless():
+                self.move_server(name, wcs, 'Headless', 'Active')
+
+    def move_server(self, name, wcs, source, destination):
+        with self.lock:
+            # The server may have been lost since the caller listed it
+            if self.web_commanding_servers[source].get(name) is not wcs:
+                return
+            del self.web_commanding_servers[source][name]
+            self.web_commanding_servers[destination][name] = wcs
+            if destination == 'Active':
+                self.camera_index.update(name, wcs)
+            else:
+                self.camera_index.remove(name)
+        self.invalidate()
+        logging.info('Moved {} @ {}:{} from {} to {}'
+          .format(name, wcs.address, wcs.port, source, destination))
 
     def update_web_commanding_servers(self):
-        self.check_headless_servers()
-        for name, wcs in self.web_commanding_servers['Active'].items():
+        # Starts polling each Active and Headless server that is due according
+        # to schedule_poll and isn't already being polled, at most
+        # max_concurrent_queries at a time. Each poll is handled as soon as it
+        # completes, so a slow server only delays itself.
+        now = time.time()
+        changed = False
+        for name, wcs in self.get_servers('Active') + self.get_servers('Headless'):
+            # Stop offering a server whose state is too old to be trusted,
+            # even if its poll has yet to fail
+            if wcs.health != 'down' and self.is_stale(wcs):
+                logging.warning('{} @ {}:{} is down because it was last polled successfully {:.0f} seconds ago'
+                  .format(name, wcs.address, wcs.port, now - wcs.updated))
+                wcs.health = 'down'
+                self.reindex(name, wcs)
+                changed = True
+            if not wcs.polling and wcs.next_poll <= now:
+                wcs.polling = True
+                self.query_pool.apply_async(self.poll_server, (name, wcs))
+        if changed:
+            self.invalidate()
+
+    def poll_server(self, name, wcs):
+        start = time.time()
+        try:
+            try:
+                result, error = wcs.update(), None
+            except Exception as e:
+                result, error = None, e
+            self.handle_poll(name, wcs, result, error)
+        except:
+            logging.error(traceback.format_exc())
+        finally:
+            wcs.polling = False
+        poll_duration.observe(time.time() - start,
+          'failed' if error is not None else 'changed' if result else 'unchanged')
+
+    def handle_poll(self, name, wcs, result, error):
+        # Polls are only made by the poller, on each server's schedule, and
+        # without a deadline, so every failure counts against the server,
+        # including timeouts
+        if error is not None:
+            if wcs.provisional:
+                self.forget_server(name, wcs, error)
+                self.invalidate()
+            elif self.record_failure(name, wcs, error):
+                self.invalidate()
+            return
+        wcs.provisional = False
+        # Look the hostname up again once the cached one expires. Any
+        # change reaches the server through set_hostname.
+        self.hostname_resolver.lookup(wcs.address)
+        if wcs.health != 'healthy':
+            logging.info('{} @ {}:{} recovered from being {}'.format(
+              name, wcs.address, wcs.port, wcs.health))
+            wcs.health = 'healthy'
+            wcs.failures = 0
+            result = True
+        self.schedule_poll(wcs, result)
+        # Skip invalidating the documents if nothing changed, which is the
+        # common case for an idle fleet
+        if result:
+            self.reindex(name, wcs)
+            self.invalidate()
+            self.check_headless_servers()
+
+    def schedule_poll(self, wcs, changed, maximum=None):
+        # Servers whose state is changing are polled every poll_interval
+        # seconds. Each time a server is found unchanged, the time until its
+        # next poll doubles, up to max_poll_interval seconds.
+        if changed:
+            wcs.poll_interval = self.configuration['poll_interval']
+        else:
+            wcs.poll_interval = min(max(wcs.poll_interval * 2, self.configuration['poll_interval']),
+                                    maximum or self.configuration['max_poll_interval'])
+        wcs.next_poll = time.time() + wcs.poll_interval
+
+    def record_failure(self, name, wcs, error):
+        # A server is suspect after a failed poll, but is still offered to
+        # clients. Once down_threshold polls in a row have failed, or none has
+        # succeeded for max_staleness seconds, it is down: it is no longer
+        # offered to clients, and polls back off to once every
+        # max_retry_interval seconds until one succeeds. Returns whether the
+        # server's health changed.
+        wcs.failures += 1
+        health = ('down' if wcs.failures >= self.configuration['down_threshold'] or self.is_stale(wcs)
+                  else 'suspect')
+        if health == 'down':
+            self.schedule_poll(wcs, False, self.configuration['max_retry_interval'])
+        else:
+            self.schedule_poll(wcs, True)
+        if health == wcs.health:
+            return False
+        logging.warning('{} @ {}:{} is {} after {} failed poll(s): {}'.format(
+          name, wcs.address, wcs.port, health, wcs.failures, error))
+        wcs.health = health
+        self.reindex(name, wcs)
+        return True
+
+    def is_stale(self, wcs):
+        return time.time() - wcs.updated > self.configuration['max_staleness']
+
+    def poll_web_commanding_servers(self):
+        while True:
             try:
-                wcs.update()
+                self.update_web_commanding_servers()
             except:
-                self.remove_service(None, None, name)
+                logging.error(traceback.format_exc())
+            time.sleep(self.configuration['poll_interval'])
 
     def get_wcs_for_camera(self, camera):
-        self.update_web_commanding_servers()
-
-        # Find servers with the camera
-        servers = [wcs for wcs in self.web_commanding_servers['Active'].values()
-                   if camera in wcs.cameras]
+        # The poller keeps the servers' state current in the background.
+        # Requests never poll themselves, since that would make every one of
+        # them wait on the slowest server.
+        return self.allocate_wcs(camera)
 
-        # No such camera exists
-        if not servers:
-            return False, None
+    def allocate_wcs(self, camera):
+        # Servers that failed to take the camera during this allocation, and
+        # whether any of them ran out of time
+        failed = set()
+        timed_out = False
+        while True:
+            with self.lock:
+                exists, rendering_servers, idle_names = self.camera_index.lookup(camera, failed)
+                idle_name = idle_names[0] if idle_names else None
+                idle_server = self.web_commanding_servers['Active'].get(idle_name)
 
-        # Filter out multi-view servers
-        servers = [wcs for wcs in servers if len(wcs.rendered_cameras) == 1]
+                # No such camera exists
+                if not exists:
+                    allocations.inc('not_found')
+                    return False, None
 
-        # Camera exists, but no server can render it individually
-        if not servers:
-            return True, None
+                # Return the server, if any, already rendering the camera with
+                # the most clients
+                if rendering_servers:
+                    allocations.inc('reused')
+                    return True, max(rendering_servers, key=operator.attrgetter('num_clients'))
 
-        # Look for servers already rendering the camera, sorted descendingly
-        # by number of clients
-        rendering_servers = sorted(
-            [wcs for wcs in servers if camera in wcs.rendered_cameras],
-            key=operator.attrgetter('num_clients'),
-            reverse=True)
+                # Either no server can render the camera individually, or all
+                # servers are busy rendering different cameras for other
+                # clients. The requested camera cannot be rendered at this
+                # time.
+                if not idle_server:
+                    if timed_out:
+                        raise DeadlineExceeded('Ran out of time commanding servers to render ' + camera)
+                    allocations.inc('unavailable')
+                    return True, None
 
-        # Return the server, if any, with the most clients
-        if rendering_servers:
-            return True, rendering_servers[0]
+                # No servers are currently rendering the camera. Reserve a
+                # server with no clients so that concurrent requests for other
+                # cameras choose different servers, and requests for this
+                # camera share it.
+                self.camera_index.reserve(idle_name, camera,
+                                          time.time() + self.configuration['reservation_lease'])
 
-        # No servers are currently rendering the camera. Return the first server
-        # with no clients
-        for wcs in servers:
-            if not wcs.num_clients:
-                wcs.set_camera(camera)
-                return True, wcs
+            # Command the server without holding the lock, so that other
+            # allocations can proceed in the meantime. If there is another
+            # server to try, this attempt gets at most half of the request's
+            # remaining time, so that a server that hangs leaves time to try
+            # it. The last one gets all of the remaining time.
+            expiration = get_deadline()
+            limit = expiration
+            if expiration and len(idle_names) > 1:
+                limit = time.time() + (expiration - time.time()) / 2
+            try:
+                with deadline(limit):
+                    idle_server.set_camera(camera)
+            except Exception as e:
+                with self.lock:
+                    self.camera_index.release(idle_name)
+                if isinstance(e, DeadlineExceeded):
+                    if time.time() >= expiration:
+                        raise
+                    timed_out = True
+                # Count the failure against the server and try another
+                logging.warning('Failed to command {} @ {}:{} to render "{}": {}'.format(
+                  idle_name, idle_server.address, idle_server.port, camera, e))
+                if self.record_failure(idle_name, idle_server, e):
+                    self.invalidate()
+                failed.add(idle_name)
+                continue
 
-        # All servers are busy rendering different cameras for other clients.
-        # The requested camera cannot be rendered at this time.
-        return True, None
+            # Watch the server closely while its client connects
+            self.schedule_poll(idle_server, True)
+            self.reindex(idle_name, idle_server)
+            self.invalidate()
+            allocations.inc('claimed')
+            return True, idle_server
 
 if __name__ == '__main__':
     try:
         if len(sys.argv) > 1:
-            VideoStreamManager(sys.argv[1])
+            manager = VideoStreamManager(sys.argv[1])
         else:
-            VideoStreamManager()
+            manager = VideoStreamManager()
+        manager.start_discovery()
+        manager.serve_forever()
     except Exception as e:
         sys.stdout.write('[Video Stream Manager] Failed to start: ')
         print e
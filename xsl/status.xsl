@@ -13,6 +13,7 @@ xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
                 <th>Host</th>
                 <th>Port</th>
                 <th>Clients</th>
+                <th>Health</th>
                 <th>Cameras</th>
               </tr>
               <xsl:for-each select="wcs">
@@ -23,6 +24,7 @@ xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
                   <td><xsl:value-of select="./@host"/></td>
                   <td><xsl:value-of select="./@port"/></td>
                   <td><xsl:value-of select="./@num_clients"/></td>
+                  <td><xsl:value-of select="./@health"/></td>
                   <td>
                     <xsl:for-each select="camera">
                       <xsl:choose>